@@ -9,16 +9,19 @@ import os.path
 import json
 import shutil
 import zipfile
+import io
+import tempfile
 
 from itertools import chain
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import fontforge
     import psMat
     # from fontTools.misc.py23 import *
     from fontTools.ttLib import TTFont
-    from fontTools.feaLib.builder import addOpenTypeFeatures, Builder
+    from fontTools.feaLib.builder import Builder
 except ImportError:
     sys.stderr.write('The required FontForge and fonttools modules could not be loaded.\n\n')
     sys.stderr.write('You need FontForge with Python bindings for this script to work.\n')
@@ -68,10 +71,24 @@ def get_argparser(ArgumentParser=argparse.ArgumentParser):
 
 FONT_NAME_RE = re.compile(r'^([^-]*)(?:(-.*))?$')
 NUM_DIGIT_COPIES = 7
+IDENTITY = psMat.identity()
+# Glyph names for the digit copies, ND_NAMES[copy_i][digit_i]
+ND_NAMES = [[sys.intern('nd{}.{}'.format(i,j)) for j in range(10)] for i in range(NUM_DIGIT_COPIES)]
+# RAM-backed scratch space for intermediate fonts if there is one, otherwise the default temp dir
+TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
 
-def gen_feature(digit_names, underscore_name, dot_name, do_decimals):
-    if do_decimals:
-        decimal_sub = """
+FEATURE_HEADER = """
+languagesystem DFLT dflt;
+languagesystem latn dflt;
+languagesystem cyrl dflt;
+languagesystem grek dflt;
+languagesystem kana dflt;
+"""[1:]
+
+# The digit copy classes are the same for every font
+ND_CLASSES = ''.join('@nd{}=[{}];\n'.format(i, ' '.join(names)) for i, names in enumerate(ND_NAMES))
+
+DECIMAL_SUB = """
     sub {dot_name} @digits' by @nd2;
     sub @nd2 @digits' by @nd1;
     sub @nd1 @digits' by @nd6;
@@ -80,25 +97,13 @@ def gen_feature(digit_names, underscore_name, dot_name, do_decimals):
     sub @nd4 @digits' by @nd3;
     sub @nd3 @digits' by @nd2;
 """
-    else:
-        decimal_sub = """
+
+NO_DECIMAL_SUB = """
     ignore sub {dot_name} @digits';
     sub @digits @digits' by @digits;
 """
 
-    decimal_sub = decimal_sub.format(dot_name=dot_name)
-
-    feature = """
-languagesystem DFLT dflt;
-languagesystem latn dflt;
-languagesystem cyrl dflt;
-languagesystem grek dflt;
-languagesystem kana dflt;
-@digits=[{digit_names}];
-{nds}
-
-feature calt {{
-    {decimal_sub}
+GROUP_SUB = """
 
     sub @digits' @digits @digits @digits by @nd0;
     sub @nd0 @digits' by @nd0;
@@ -110,22 +115,22 @@ feature calt {{
     reversesub @nd0' @nd4 by @nd5;
     reversesub @nd0' @nd5 by @nd6;
     reversesub @nd0' @nd6 by @nd1;
-}} calt;
-"""[1:]
-
-    nds = [' '.join(['nd{}.{}'.format(i,j) for j in range(10)]) for i in range(NUM_DIGIT_COPIES)]
-    nds = ['@nd{}=[{}];'.format(i,nds[i]) for i in range(NUM_DIGIT_COPIES)]
-    nds = "\n".join(nds)
-    feature = feature.format(digit_names=' '.join(digit_names),
-        nds=nds, underscore_name=underscore_name, decimal_sub=decimal_sub)
-    with open('mods.fea', 'w') as f:
-        f.write(feature)
+"""
 
-def shift_layer(layer, shift):
-    layer = layer.dup()
-    mat = psMat.translate(shift, 0)
-    layer.transform(mat)
-    return layer
+def write_feature(f, digit_names, dot_name, do_decimals):
+    f.write(FEATURE_HEADER)
+    f.write('@digits=[{}];\n'.format(' '.join(digit_names)))
+    f.write(ND_CLASSES)
+    f.write('\nfeature calt {\n    ')
+    decimal_sub = DECIMAL_SUB if do_decimals else NO_DECIMAL_SUB
+    f.write(decimal_sub.format(dot_name=dot_name))
+    f.write(GROUP_SUB)
+    f.write('} calt;\n')
+
+def gen_feature(digit_names, dot_name, do_decimals):
+    f = io.StringIO()
+    write_feature(f, digit_names, dot_name, do_decimals)
+    return f.getvalue()
 
 def squish_layer(layer, squish):
     layer = layer.dup()
@@ -133,22 +138,31 @@ def squish_layer(layer, squish):
     layer.transform(mat)
     return layer
 
-def add_comma_to(glyph, comma_glyph, spaceless):
+def outline_layer(glyph):
+    # glyph.layers only holds contours, so bake any references in as contours too.
+    # Reading glyph.layers already hands back a fresh copy, so there's no need to dup() it.
+    layer = glyph.layers[1]
+    for ref in glyph.references:
+        ref_name, ref_mat = ref[0], ref[1]
+        ref_layer = outline_layer(glyph.font[ref_name])
+        ref_layer.transform(ref_mat)
+        layer += ref_layer
+    return layer
+
+def comma_layer_for(width, comma_glyph, spaceless):
     comma_layer = comma_glyph.layers[1].dup()
-    x_shift = glyph.width
+    x_shift = width
     y_shift = 0
+    mat = IDENTITY
     if spaceless:
         mat = psMat.scale(0.8, 0.8)
-        comma_layer.transform(mat)
         x_shift -= comma_glyph.width / 2
         # y_shift = -200
-    mat = psMat.translate(x_shift, y_shift)
+    mat = psMat.compose(mat, psMat.translate(x_shift, y_shift))
     comma_layer.transform(mat)
-    glyph.layers[1] += comma_layer
-    if not spaceless:
-        glyph.width += comma_glyph.width
+    return comma_layer
 
-def annotate_glyph(glyph, extra_glyph):
+def annotate_layer_for(extra_glyph):
     layer = extra_glyph.layers[1].dup()
     mat = psMat.translate(-(extra_glyph.width/2), 0)
     layer.transform(mat)
@@ -158,7 +172,7 @@ def annotate_glyph(glyph, extra_glyph):
     layer.transform(mat)
     mat = psMat.translate(0, -600)
     layer.transform(mat)
-    glyph.layers[1] += layer
+    return layer
 
 def out_path(name):
     return 'out/{0}.ttf'.format(name)
@@ -172,108 +186,147 @@ def patch_one_font(font, rename_font, add_underlines, shift_amount, squish, squi
         squish = 0.85
         squish_all = True
 
-    mod_name = 'N'
+    name_parts = ['N']
     if add_commas:
         if spaceless_commas:
-            mod_name += 'onoCommas'
+            name_parts.append('onoCommas')
         else:
-            mod_name += 'ommas'
+            name_parts.append('ommas')
     if add_underlines:
-        mod_name += 'umderline'
+        name_parts.append('umderline')
     if sub_font is not None:
-        mod_name += 'Sub'
+        name_parts.append('Sub')
     # Cleaner name for what I expect to be a common combination
     if shift_amount == 100 and squish == 0.85 and squish_all:
-        mod_name += 'Group'
+        name_parts.append('Group')
     else:
         if shift_amount != 0:
-            mod_name += 'Shift{}'.format(shift_amount)
+            name_parts.append('Shift{}'.format(shift_amount))
         if squish != 1.0:
             squish_s = '{}'.format(squish)
-            mod_name += 'Squish{}'.format(squish_s.replace('.','p'))
+            name_parts.append('Squish{}'.format(squish_s.replace('.','p')))
             if squish_all:
-                mod_name += 'All'
+                name_parts.append('All')
     if debug_annotate:
-        mod_name += 'Debug'
+        name_parts.append('Debug')
     if not do_decimals:
-        mod_name += 'NoDecimals'
+        name_parts.append('NoDecimals')
+    mod_name = ''.join(name_parts)
 
     # Rename font
     if rename_font:
         font.familyname += ' with '+mod_name
         font.fullname += ' with '+mod_name
         fontname, style = FONT_NAME_RE.match(font.fontname).groups()
-        font.fontname = fontname + 'With' + mod_name
-        if style is not None:
-            font.fontname += style
+        font.fontname = '{}With{}{}'.format(fontname, mod_name, style or '')
         font.appendSFNTName(
             'English (US)', 'Preferred Family', font.familyname)
         font.appendSFNTName(
             'English (US)', 'Compatible Full', font.fullname)
 
-    digit_names = [font[code].glyphname for code in range(ord('0'),ord('9')+1)]
-    test_names = [font[code].glyphname for code in range(ord('A'),ord('J')+1)]
-    underscore_name = font[ord('_')].glyphname
+    digit_glyphs = [font[code] for code in range(ord('0'),ord('9')+1)]
+    digit_names = [glyph.glyphname for glyph in digit_glyphs]
+    underscore_glyph = font[ord('_')]
     dot_name = font[ord('.')].glyphname
     # print(digit_names)
 
     if sub_font is not None:
-        sub_font = fontforge.open(sub_font.name)
+        sub_font = fontforge.open(sub_font)
+
+    underscore_layer = underscore_glyph.layers[1]
 
-    underscore_layer = font[underscore_name].layers[1]
+    # The comma overlay only depends on the width of the digit it's attached to,
+    # which is the same for every digit in a monospace font, so build it once per width
+    if add_commas:
+        comma_glyph = font[ord(',')]
+        comma_width = 0 if spaceless_commas else comma_glyph.width
+        comma_layers = {}
+        def cached_comma_layer(width):
+            comma_layer = comma_layers.get(width)
+            if comma_layer is None:
+                comma_layer = comma_layer_for(width, comma_glyph, spaceless_commas)
+                comma_layers[width] = comma_layer
+            return comma_layer
 
     # 0xE900 starts an area spanning until 0xF000 that as far as I can tell nothing
     # popular uses. I checked the Apple glyph browser and Nerd Font.
-    # Uses an array because of python closure capture semantics
-    encoding_alloc = [0xE900]
-    def make_copy(src_font, loc, to_name, add_underscore, add_comma, shift, squish, annotate_with):
-        encoding = encoding_alloc[0]
-        src_font.selection.select(loc)
-        src_font.copy()
-        font.selection.select(encoding)
-        font.paste()
-        glyph = font[encoding]
-        glyph.glyphname = to_name
-        if squish != 1.0:
-            glyph.layers[1] = squish_layer(glyph.layers[1], squish)
-        if shift != 0:
-            glyph.layers[1] = shift_layer(glyph.layers[1], shift)
-        if add_underscore:
-            glyph.layers[1] += underscore_layer
+    def alloc_copy(encoding, name):
+        glyph = font.createChar(encoding, name)
+        # createChar hands back any glyph already at this encoding untouched, so
+        # clear out its contours, references, hints and instructions like pasting did
+        glyph.clear()
+        glyph.glyphname = name
+        return glyph
+
+    # All the copies are allocated up front, copy_glyphs[copy_i][digit_i]
+    copy_glyphs = [[alloc_copy(0xE900 + copy_i*10 + digit_i, ND_NAMES[copy_i][digit_i])
+        for digit_i in range(0,10)] for copy_i in range(0,NUM_DIGIT_COPIES)]
+
+    # mat and overlays are the same for every digit in a copy, so the caller builds them once
+    def make_copy(src_glyph, glyph, mat, overlays, add_comma):
+        # Copy the outlines directly rather than through FontForge's clipboard,
+        # layers can be assigned between open fonts as well. References are flattened
+        # since the sub font's glyph names don't exist in this font.
+        layer = outline_layer(src_glyph)
+        # Pasting used to convert to this font's curve order, the overlays need it to match
+        layer.is_quadratic = glyph.layers[1].is_quadratic
+        if mat is not None:
+            layer.transform(mat)
+        for overlay in overlays:
+            layer += overlay
+        width = src_glyph.width
         if add_comma:
-            add_comma_to(glyph, font[ord(',')], spaceless_commas)
-        if annotate_with is not None:
-            annotate_glyph(glyph, annotate_with)
-        encoding_alloc[0] += 1
+            layer += cached_comma_layer(width)
+            width += comma_width
+        glyph.layers[1] = layer
+        glyph.width = width
 
     for copy_i in range(0,NUM_DIGIT_COPIES):
+        shift = 0
+        if copy_i % 3 == 0:
+            shift = -shift_amount
+        elif copy_i % 3 == 2:
+            shift = shift_amount
+        in_alternating_group = (copy_i >= 3 and copy_i < 6)
+        add_underscore = add_underlines and in_alternating_group
+        add_comma = add_commas and (copy_i == 3 or copy_i == 6)
+        use_sub_font = (sub_font is not None) and in_alternating_group
+
+        # squish then shift, composed so the contours are only walked once
+        mat = psMat.compose(psMat.scale(squish, 1.0), psMat.translate(shift, 0))
+        if mat == IDENTITY:
+            mat = None
+
+        # Overlays are glyph layers so they match the font's curve order
+        overlays = []
+        if add_underscore:
+            overlays.append(underscore_layer)
+        if debug_annotate:
+            overlays.append(annotate_layer_for(digit_glyphs[copy_i]))
+
         for digit_i in range(0,10):
-            shift = 0
-            if copy_i % 3 == 0:
-                shift = -shift_amount
-            elif copy_i % 3 == 2:
-                shift = shift_amount
-            in_alternating_group = (copy_i >= 3 and copy_i < 6)
-            add_underscore = add_underlines and in_alternating_group
-            add_comma = add_commas and (copy_i == 3 or copy_i == 6)
-            annotate_with = font[digit_names[copy_i]] if debug_annotate else None
-            use_sub_font = (sub_font is not None) and in_alternating_group
-            src_font = sub_font if use_sub_font else font
-            make_copy(src_font, digit_names[digit_i], 'nd{}.{}'.format(copy_i,digit_i), add_underscore, add_comma, shift, squish, annotate_with)
+            src_glyph = sub_font[digit_names[digit_i]] if use_sub_font else digit_glyphs[digit_i]
+            make_copy(src_glyph, copy_glyphs[copy_i][digit_i], mat, overlays, add_comma)
 
     if squish_all and squish != 1.0:
-        for digit in digit_names:
-            glyph = font[digit]
+        for glyph in digit_glyphs:
             glyph.layers[1] = squish_layer(glyph.layers[1], squish)
 
-    gen_feature(digit_names, underscore_name, dot_name, do_decimals)
-
-    font.generate('out/tmp.ttf')
-    ft_font = TTFont('out/tmp.ttf')
-    addOpenTypeFeatures(ft_font, 'mods.fea', tables=['GSUB'])
     # replacement to comply with SIL Open Font License
     out_name = font.fullname.replace('Source ', 'Sauce ')
-    ft_font.save(out_path(out_name))
+    # The feature source never touches disk, so fonts can be patched in parallel
+    fea_source = gen_feature(digit_names, dot_name, do_decimals)
+    # The intermediate font only lives as long as it takes fontTools to add the
+    # features, so keep it in memory where the OS lets us
+    with tempfile.NamedTemporaryFile(suffix='.ttf', dir=TMP_DIR) as tmp:
+        font.generate(tmp.name)
+        # lazy so only the tables we touch get decompiled, the rest are copied verbatim.
+        # FontForge already set the timestamp and bounding boxes when generating.
+        ft_font = TTFont(tmp.name, lazy=True, recalcTimestamp=False, recalcBBoxes=False)
+        Builder(ft_font, io.StringIO(fea_source)).build(tables=['GSUB'])
+        # The optimized table order is only a loading nicety, skip the reordering pass
+        ft_font.save(out_path(out_name), reorderTables=False)
+        ft_font.close()
     print("> Created '{}'".format(out_name))
 
     if sub_font is not None:
@@ -282,15 +335,23 @@ def patch_one_font(font, rename_font, add_underlines, shift_amount, squish, squi
     return out_name
 
 
+def patch_one_file(path, args):
+    target_font = fontforge.open(path)
+    try:
+        return patch_one_font(target_font, *args)
+    finally:
+        target_font.close()
+
 def patch_fonts(target_files, *args):
-    res = None
-    for target_file in target_files:
-        target_font = fontforge.open(target_file.name)
-        try:
-            res = patch_one_font(target_font, *args)
-        finally:
-            target_font.close()
-    return res
+    paths = [target_file.name for target_file in target_files]
+    if len(paths) <= 1:
+        res = [patch_one_file(path, args) for path in paths]
+    else:
+        # FontForge isn't thread safe and keeps global state, so patch each font in its own process
+        max_workers = min(len(paths), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            res = list(executor.map(patch_one_file, paths, [args]*len(paths)))
+    return res[-1] if res else None
 
 def source_font_path(weight, is_italic):
     suffix = weight
@@ -370,7 +431,9 @@ def main(argv):
         return
 
     return patch_fonts(args.target_fonts, args.rename_font, args.add_underlines, args.shift_amount, args.squish, args.squish_all,
-        args.add_commas, args.spaceless_commas, args.debug_annotate, args.do_decimals, args.group, args.sub_font)
+        args.add_commas, args.spaceless_commas, args.debug_annotate, args.do_decimals, args.group,
+        args.sub_font.name if args.sub_font is not None else None)
 
 
-main(sys.argv[1:])
+if __name__ == '__main__':
+    main(sys.argv[1:])